@@ -1,5 +1,11 @@
 import streamlit as st
+import pandas as pd
 import logging
+import os
+import hmac
+import hashlib
+import time
+from functools import lru_cache
 from supabase import create_client, Client
 from datetime import datetime
 
@@ -7,49 +13,168 @@ from datetime import datetime
 SUPABASE_URL = st.secrets["supabase_url"]
 SUPABASE_KEY = st.secrets["supabase_key"]
 ADMIN_PASSWORD = st.secrets["admin_password"]
+ADMIN_PASSWORD_BYTES = ADMIN_PASSWORD.encode()
+# Only the columns the dashboard renders (status is needed to split the lists)
+REQUEST_COLUMNS = "id,phone,submitted_at,screenshot_link,documents,status"
+FETCH_CACHE_TTL = 5  # seconds
+# Document fields shown in the admin table, in display order
+DOCUMENT_COLUMNS = ['doc_link', 'pages', 'copies', 'is_color', 'layout', 'pages_per_sheet', 'page_selection', 'price']
+AUTH_TOKEN_TTL = 60 * 60  # seconds
+AUTH_SECRET = st.secrets.get("auth_secret", ADMIN_PASSWORD).encode()
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Set PRINTEASY_DEBUG=1 to enable debug logging
+LOG_LEVEL = logging.DEBUG if os.environ.get("PRINTEASY_DEBUG") else logging.INFO
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+@st.cache_resource
+def get_supabase():
+    """Create the Supabase client once and share it across reruns and sessions."""
+    client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    logger.info("Supabase initialized successfully")
+    return client
+
 supabase = None
 try:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    logger.info("Supabase initialized successfully")
+    supabase = get_supabase()
 except Exception as e:
-    logger.error(f"Failed to initialize Supabase: {str(e)}")
+    logger.error("Failed to initialize Supabase: %s", e)
     st.error(f"Failed to connect to database: {str(e)}")
 
 # --- Supabase Functions ---
-def fetch_requests(status="Pending"):
-    """Fetch requests from Supabase based on status."""
+@st.cache_data(ttl=FETCH_CACHE_TTL, show_spinner=False)
+def fetch_requests(statuses=("Pending", "Done")):
+    """Fetch requests with any of the given statuses from Supabase in one query."""
     if not supabase:
         st.error("Database connection unavailable.")
         return []
     try:
-        response = supabase.table("print_requests").select("*").eq("status", status).order("submitted_at", desc=True).execute()
+        # Served by an index created once in the Supabase SQL editor:
+        # CREATE INDEX IF NOT EXISTS idx_status_submitted ON print_requests (status, submitted_at DESC);
+        response = supabase.table("print_requests").select(REQUEST_COLUMNS).in_("status", list(statuses)).order("submitted_at", desc=True).execute()
         # Ensure response.data is a list, even if the query fails
         return response.data if response.data is not None else []
     except Exception as e:
-        logger.error(f"Failed to fetch requests: {str(e)}")
+        logger.error("Failed to fetch requests: %s", e)
         st.error(f"Failed to fetch requests: {str(e)}")
         return []
 
-def update_request_status(request_id, new_status):
-    """Update the status of a request in Supabase."""
+def update_requests_status(request_ids, new_status):
+    """Update the status of several requests in Supabase with a single query."""
     if not supabase:
         st.error("Database connection unavailable.")
         return False
     try:
-        response = supabase.table("print_requests").update({"status": new_status}).eq("id", request_id).execute()
+        response = supabase.table("print_requests").update({"status": new_status}).in_("id", list(request_ids)).execute()
         if response.data:
-            logger.info(f"Updated request ID {request_id} to status '{new_status}'")
+            logger.info("Updated request IDs %s to status '%s'", request_ids, new_status)
+            fetch_requests.clear()
             return True
         return False
     except Exception as e:
-        logger.error(f"Failed to update request ID {request_id}: {str(e)}")
-        st.error(f"Failed to update request: {str(e)}")
+        logger.error("Failed to update request IDs %s: %s", request_ids, e)
+        st.error(f"Failed to update requests: {str(e)}")
+        return False
+
+DOCUMENT_COLUMN_CONFIG = {
+    'doc_link': st.column_config.LinkColumn("Document", display_text="View"),
+    'pages': "Pages",
+    'copies': "Copies",
+    'is_color': st.column_config.CheckboxColumn("Color"),
+    'layout': "Layout",
+    'pages_per_sheet': "Pages per Sheet",
+    'page_selection': "Page Selection",
+    'price': st.column_config.NumberColumn("Price", format="₹%.2f")
+}
+REQUEST_COLUMN_CONFIG = {
+    'id': "Request ID",
+    'phone': "Phone",
+    'submitted_at': "Submitted",
+    'screenshot_link': st.column_config.LinkColumn("Payment Screenshot", display_text="View"),
+    'documents': "Documents",
+    'total_price': st.column_config.NumberColumn("Total Price", format="₹%.2f")
+}
+
+# --- Authentication Helpers ---
+def make_auth_token(issued_at=None):
+    """Return an HMAC-signed login token for the given issue time."""
+    if issued_at is None:
+        issued_at = int(time.time())
+    signature = hmac.new(AUTH_SECRET, str(issued_at).encode(), hashlib.sha256).hexdigest()
+    return f"{issued_at}.{signature}"
+
+def verify_auth_token(token):
+    """Check that a login token is correctly signed and has not expired."""
+    try:
+        issued_at, _ = token.split(".", 1)
+        issued_at = int(issued_at)
+    except (AttributeError, ValueError):
+        return False
+    if time.time() - issued_at > AUTH_TOKEN_TTL:
         return False
+    return hmac.compare_digest(token, make_auth_token(issued_at))
+
+# --- Rendering Helpers ---
+@lru_cache(maxsize=256)
+def format_link(url):
+    """Return a markdown "View" link, handling missing (None or empty) links."""
+    return f"[View]({url})" if url else "Not provided"
+
+def document_prices(documents):
+    """Return the documents' prices as floats, treating missing or invalid prices as 0."""
+    prices = pd.Series([doc.get('price') for doc in documents], dtype=object)
+    return pd.to_numeric(prices, errors='coerce').fillna(0.0)
+
+def render_documents(documents):
+    """Render a request's documents as one table and show the total price."""
+    docs_df = pd.DataFrame(documents).reindex(columns=DOCUMENT_COLUMNS)
+    docs_df['price'] = document_prices(documents).to_numpy()
+    st.dataframe(docs_df, column_config=DOCUMENT_COLUMN_CONFIG, hide_index=True)
+    st.write(f"**Total Price:** ₹{docs_df['price'].sum():.2f}")
+
+def render_request(request):
+    """Render one request as an expander with its payment proof and documents."""
+    with st.expander(f"Request ID: {request['id']} | Phone: {request['phone']} | Submitted: {request['submitted_at']}", expanded=True):
+        st.write(f"**Payment Screenshot:** {format_link(request.get('screenshot_link'))}")
+
+        # Handle documents being None or empty
+        documents = request.get('documents') or []
+        if not documents:
+            st.write("**Documents:** No documents found.")
+            return
+
+        st.write("**Documents:**")
+        render_documents(documents)
+
+def render_request_list(requests, key):
+    """Render requests as one summary table plus a details view for the selected request."""
+    summary_df = pd.DataFrame([
+        {
+            'id': request['id'],
+            'phone': request['phone'],
+            'submitted_at': request['submitted_at'],
+            'screenshot_link': request.get('screenshot_link'),
+            'documents': len(request.get('documents') or []),
+            'total_price': document_prices(request.get('documents') or []).sum()
+        }
+        for request in requests
+    ])
+    st.dataframe(summary_df, column_config=REQUEST_COLUMN_CONFIG, hide_index=True)
+
+    requests_by_id = {request['id']: request for request in requests}
+    # Forget a selection whose request has moved to the other list
+    if st.session_state.get(f"{key}_details") not in requests_by_id:
+        st.session_state.pop(f"{key}_details", None)
+    selected_id = st.selectbox(
+        "View request details",
+        list(requests_by_id),
+        index=None,
+        placeholder="Choose a request ID",
+        key=f"{key}_details"
+    )
+    if selected_id is not None:
+        render_request(requests_by_id[selected_id])
 
 # --- Streamlit App UI ---
 st.set_page_config(page_title="PrintEasy Admin", layout="wide")
@@ -63,12 +188,17 @@ if not supabase:
 if "authenticated" not in st.session_state:
     st.session_state.authenticated = False
 
+# Restore a login from a signed token so reloads skip the password form
+if not st.session_state.authenticated and verify_auth_token(st.query_params.get("auth")):
+    st.session_state.authenticated = True
+
 if not st.session_state.authenticated:
     st.subheader("Admin Login")
     password = st.text_input("Enter Admin Password", type="password")
     if st.button("Login"):
-        if password == ADMIN_PASSWORD:
+        if hmac.compare_digest(password.encode(), ADMIN_PASSWORD_BYTES):
             st.session_state.authenticated = True
+            st.query_params["auth"] = make_auth_token()
             st.success("Login successful!")
             st.rerun()
         else:
@@ -76,99 +206,50 @@ if not st.session_state.authenticated:
     st.stop()
 
 # --- Admin Dashboard ---
-st.subheader("Pending Requests")
-
-# Fetch and display pending requests
-pending_requests = fetch_requests("Pending")
-if not pending_requests:
-    st.info("No pending requests.")
-else:
-    for request in pending_requests:
-        with st.expander(f"Request ID: {request['id']} | Phone: {request['phone']} | Submitted: {request['submitted_at']}"):
-            # Handle screenshot_link being None
-            screenshot_link = request.get('screenshot_link', 'Not provided')
-            st.write(f"**Payment Screenshot:** {'[View](' + screenshot_link + ')' if screenshot_link != 'Not provided' else 'Not provided'}")
-            
-            # Handle documents being None or empty
-            documents = request.get('documents', [])
-            if not documents:
-                st.write("**Documents:** No documents found.")
-                continue
-            
-            st.write("**Documents:**")
-            total_price = 0.0
-            for idx, doc in enumerate(documents, 1):
-                # Defensive checks for document fields
-                doc_link = doc.get('doc_link', 'Not provided')
-                pages = doc.get('pages', 0)
-                copies = doc.get('copies', 1)
-                is_color = doc.get('is_color', False)
-                layout = doc.get('layout', 'Unknown')
-                pages_per_sheet = doc.get('pages_per_sheet', 'Unknown')
-                page_selection = doc.get('page_selection', 'All Pages')
-                price = float(doc.get('price', 0.0))  # Ensure price is a float
-                
-                st.write(f"**Document {idx}:** {'[View](' + doc_link + ')' if doc_link != 'Not provided' else 'Not provided'}")
-                st.write(f"  - Pages: {pages}")
-                st.write(f"  - Copies: {copies}")
-                st.write(f"  - Mode: {'Color' if is_color else 'Black & White'}")
-                st.write(f"  - Layout: {layout}")
-                st.write(f"  - Pages per Sheet: {pages_per_sheet}")
-                st.write(f"  - Page Selection: {page_selection}")
-                st.write(f"  - Price: ₹{price:.2f}")
-                total_price += price
-            st.write(f"**Total Price:** ₹{total_price:.2f}")
-            
-            # Mark as Done button
-            if st.button(f"Mark as Done", key=f"done_{request['id']}"):
-                if update_request_status(request['id'], "Done"):
-                    st.success(f"Request ID {request['id']} marked as Done.")
-                    st.rerun()
-
-# --- Display Completed Requests ---
-st.subheader("Completed Requests")
-completed_requests = fetch_requests("Done")
-if not completed_requests:
-    st.info("No completed requests.")
-else:
-    for request in completed_requests:
-        with st.expander(f"Request ID: {request['id']} | Phone: {request['phone']} | Submitted: {request['submitted_at']}"):
-            # Handle screenshot_link being None
-            screenshot_link = request.get('screenshot_link', 'Not provided')
-            st.write(f"**Payment Screenshot:** {'[View](' + screenshot_link + ')' if screenshot_link != 'Not provided' else 'Not provided'}")
-            
-            # Handle documents being None or empty
-            documents = request.get('documents', [])
-            if not documents:
-                st.write("**Documents:** No documents found.")
-                continue
-            
-            st.write("**Documents:**")
-            total_price = 0.0
-            for idx, doc in enumerate(documents, 1):
-                doc_link = doc.get('doc_link', 'Not provided')
-                pages = doc.get('pages', 0)
-                copies = doc.get('copies', 1)
-                is_color = doc.get('is_color', False)
-                layout = doc.get('layout', 'Unknown')
-                pages_per_sheet = doc.get('pages_per_sheet', 'Unknown')
-                page_selection = doc.get('page_selection', 'All Pages')
-                price = float(doc.get('price', 0.0))
-                
-                st.write(f"**Document {idx}:** {'[View](' + doc_link + ')' if doc_link != 'Not provided' else 'Not provided'}")
-                st.write(f"  - Pages: {pages}")
-                st.write(f"  - Copies: {copies}")
-                st.write(f"  - Mode: {'Color' if is_color else 'Black & White'}")
-                st.write(f"  - Layout: {layout}")
-                st.write(f"  - Pages per Sheet: {pages_per_sheet}")
-                st.write(f"  - Page Selection: {page_selection}")
-                st.write(f"  - Price: ₹{price:.2f}")
-                total_price += price
-            st.write(f"**Total Price:** ₹{total_price:.2f}")
+@st.fragment
+def render_dashboard():
+    """Render the request lists; actions inside rerun only this fragment."""
+    # Fetch both lists in a single round-trip and split them client-side
+    all_requests = fetch_requests(("Pending", "Done"))
+    pending_requests = [request for request in all_requests if request.get('status') == "Pending"]
+    completed_requests = [request for request in all_requests if request.get('status') == "Done"]
+
+    st.subheader("Pending Requests")
+
+    # Display pending requests
+    if not pending_requests:
+        st.info("No pending requests.")
+    else:
+        # One selector + button for all rows; selected IDs are updated with one query
+        pending_ids = [request['id'] for request in pending_requests]
+        st.session_state.pending_done_ids = [
+            request_id for request_id in st.session_state.get("pending_done_ids", []) if request_id in pending_ids
+        ]
+        selected_ids = st.multiselect(
+            "Select requests to mark as Done",
+            pending_ids,
+            key="pending_done_ids"
+        )
+        if st.button(f"Mark {len(selected_ids)} as Done", key="commit_done", disabled=not selected_ids):
+            if update_requests_status(selected_ids, "Done"):
+                st.success(f"Request IDs {', '.join(str(request_id) for request_id in selected_ids)} marked as Done.")
+                st.rerun(scope="fragment")
+
+        render_request_list(pending_requests, "pending")
+
+    # --- Display Completed Requests ---
+    st.subheader("Completed Requests")
+    if not completed_requests:
+        st.info("No completed requests.")
+    else:
+        render_request_list(completed_requests, "completed")
+
+render_dashboard()
 
 # --- Logout Button ---
 if st.button("Logout"):
     st.session_state.authenticated = False
+    st.query_params.pop("auth", None)
     st.rerun()
 
 # Footer
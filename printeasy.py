@@ -1,118 +1,498 @@
 import streamlit as st
 import pypdf
 import io
+import hashlib
+from PIL import Image
 import re
 from datetime import datetime
 import logging
-from supabase import create_client, Client
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
-from urllib.parse import quote
+import os
+import queue
+import random
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import quote, quote_from_bytes
 
 
 MAX_DOC_SIZE_MB = 10
 MAX_IMG_SIZE_MB = 5
 MAX_DOC_SIZE_BYTES = MAX_DOC_SIZE_MB * 1024 * 1024
 MAX_IMG_SIZE_BYTES = MAX_IMG_SIZE_MB * 1024 * 1024
-PHONE_REGEX = r'^\d{10}$'
+# The PDF header may be preceded by junk, but must start within the first 1024 bytes
+PDF_MAGIC = b'%PDF-'
+PDF_HEADER_SEARCH_BYTES = 1024
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+)
+RESUMABLE_UPLOAD_THRESHOLD_BYTES = 5 * 1024 * 1024
+# Resumable chunks must be a multiple of 256 KiB; 8 MiB sends a 10 MB document in two requests
+RESUMABLE_CHUNK_SIZE_BYTES = 8 * 1024 * 1024
+DRIVE_UPLOAD_WORKERS = 8
+DRIVE_NUM_RETRIES = 5
+SCREENSHOT_MAX_DIMENSION = 1280
+SCREENSHOT_JPEG_QUALITY = 80
+SUBMISSION_POLL_SECONDS = 1
+SUBMISSION_WORKERS = 4
+WRITE_BATCH_SIZE = 32
+WRITE_BATCH_WAIT_SECONDS = 0.05
+# Maps every ASCII character that is not a letter, digit or underscore to '_'
+_SANITIZE_TABLE = str.maketrans({c: '_' for c in map(chr, range(128)) if not (c.isalnum() or c == '_')})
+# A custom page selection is a comma-separated list of pages or ranges, e.g. "1-3, 5, 7-10"
+_RANGE_RE = re.compile(r'(\d+)(?:\s*-\s*(\d+))?')
+_PAGE_SPEC_RE = re.compile(r'\s*\d+(?:\s*-\s*\d+)?(?:\s*,\s*\d+(?:\s*-\s*\d+)?)*\s*,?\s*')
 SHOP_NUMBER = st.secrets["shop_number"]
 FOLDER_ID = st.secrets["folder_id"]
 SUPABASE_URL = st.secrets["supabase_url"]
 SUPABASE_KEY = st.secrets["supabase_key"]
 COLOR_PRICE_PER_SIDE = 5.0
 BW_PRICE_PER_SIDE = 2.0
+# Twice the price per page, indexed [is_color][is_double_sided]; double-sided pages cost half
+_PRICE_PER_PAGE_X2 = (
+    (BW_PRICE_PER_SIDE * 2, BW_PRICE_PER_SIDE),
+    (COLOR_PRICE_PER_SIDE * 2, COLOR_PRICE_PER_SIDE),
+)
 UPI_LINK = "upi://pay"
+# Static parts of the WhatsApp message, percent-encoded once at import
+_WHATSAPP_HEADER = quote("New Urgent Print Request\n", safe="")
+_WHATSAPP_FOOTER = quote("\n---\nPlease confirm the order details.", safe="")
+_MODE_LABELS = {True: "Color", False: "Black & White"}
+# Print mode radio options, formatted once rather than on every rerun
+_BW_LABEL = f"⚫ Black & White (₹{BW_PRICE_PER_SIDE:.2f}/side)"
+_COLOR_LABEL = f"🌈 Color (₹{COLOR_PRICE_PER_SIDE:.2f}/side)"
 
 # Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Set PRINTEASY_DEBUG=1 to enable debug logging
+LOG_LEVEL = logging.DEBUG if os.environ.get("PRINTEASY_DEBUG") else logging.INFO
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Global Supabase Client ---
+@st.cache_resource
+def get_supabase():
+    """Create the Supabase client once and share it across reruns and sessions."""
+    # The Google and Supabase SDKs are imported where first used to keep app start-up fast
+    from supabase import create_client
+    client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    logger.info("Supabase initialized successfully")
+    return client
+
 supabase = None
 try:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    logger.info("Supabase initialized successfully")
+    supabase = get_supabase()
 except Exception as e:
-    logger.error(f"Failed to initialize Supabase: {str(e)}")
+    logger.error("Failed to initialize Supabase: %s", e)
     st.error(f"Failed to connect to database: {str(e)}")
 
 # --- Helper Functions ---
 def validate_phone(phone):
     """Checks if the phone number is exactly 10 digits."""
-    return bool(phone and re.match(PHONE_REGEX, phone))
+    return bool(phone) and len(phone) == 10 and phone.isascii() and phone.isdigit()
+
+def parse_pages(spec, max_page):
+    """Parses a page spec like "1-3, 5" into a sorted list of pages clamped to 1..max_page.
 
+    Returns None if the spec is malformed, has an inverted range, or selects no pages.
+    """
+    if not spec or not _PAGE_SPEC_RE.fullmatch(spec):
+        return None
+    pages = set()
+    for match in _RANGE_RE.finditer(spec):
+        start = int(match.group(1))
+        end = int(match.group(2) or start)
+        if start > end:
+            return None
+        pages.update(range(max(start, 1), min(end, max_page) + 1))
+    return sorted(pages) or None
+
+def format_page_ranges(pages):
+    """Formats a sorted page list as compact ranges, e.g. [1, 2, 3, 5] -> "1-3, 5"."""
+    ranges = []
+    start = prev = pages[0]
+    for page in pages[1:]:
+        if page != prev + 1:
+            ranges.append((start, prev))
+            start = page
+        prev = page
+    ranges.append((start, prev))
+    return ", ".join(str(first) if first == last else f"{first}-{last}" for first, last in ranges)
+
+def is_pdf(file_content):
+    """Checks for the PDF header without parsing the file."""
+    return PDF_MAGIC in file_content[:PDF_HEADER_SEARCH_BYTES]
+
+def sniff_image_type(file_content):
+    """Returns the MIME type of a JPEG or PNG image from its magic bytes, or None."""
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if file_content.startswith(signature):
+            return mimetype
+    return None
+
+@st.cache_data(max_entries=32, show_spinner=False)
 def get_pdf_page_count(file_content):
-    """Reads the PDF file content and returns the page count."""
+    """Reads the PDF file content and returns the page count, or 0 if it cannot be read.
+
+    Cached by content, so re-uploading the same file skips the parse.
+    """
     if not file_content:
         logger.warning("get_pdf_page_count called with empty content.")
         return 0
     try:
-        pdf_reader = pypdf.PdfReader(io.BytesIO(file_content))
-        count = len(pdf_reader.pages)
-        logger.info(f"Read {count} pages from PDF.")
+        # BytesIO over the existing bytes shares the buffer instead of copying it
+        pdf_reader = pypdf.PdfReader(io.BytesIO(file_content), strict=False)
+        count = None
+        if not pdf_reader.is_encrypted:
+            # The root /Pages node stores the total, so the page tree need not be walked
+            count = pdf_reader.trailer["/Root"]["/Pages"].get("/Count")
+        if not isinstance(count, int) or count <= 0:
+            # Encrypted file or missing/bogus /Count; the full walk raises for unreadable files
+            count = len(pdf_reader.pages)
+        logger.debug("Read %d pages from PDF.", count)
         return count
     except Exception as e:
-        st.error(f"Error reading PDF: The file might be corrupted or password-protected. {str(e)}")
-        logger.error(f"PDF read error: {str(e)}")
+        logger.error("PDF read error: %s", e)
         return 0
 
+@lru_cache(maxsize=64)
 def calculate_price(page_count, copies, is_color, print_layout):
     """Calculates the printing price for a single file."""
     if page_count <= 0 or copies <= 0:
         return 0.0
-    base_price_per_side = COLOR_PRICE_PER_SIDE if is_color else BW_PRICE_PER_SIDE
-    price_multiplier = 0.5 if print_layout == "Double-sided" else 1.0
-    return page_count * base_price_per_side * price_multiplier * copies
+    return page_count * copies * _PRICE_PER_PAGE_X2[bool(is_color)][print_layout == "Double-sided"] / 2
+
+def billable_page_count(file_data):
+    """Returns the number of pages to print: the custom selection if one is set, else every page."""
+    preferences = file_data['preferences']
+    if preferences['page_preference'] == "Custom Pages" and preferences['selected_pages']:
+        return len(preferences['selected_pages'])
+    return file_data['page_count']
 
-def upload_to_drive(file_content, file_name, folder_id):
-    """Uploads file content to a specific Google Drive folder."""
+def compress_screenshot(image_content, mimetype):
+    """Downscales and re-encodes a payment screenshot as JPEG; returns (content, mimetype).
+
+    The original image is kept if it cannot be decoded or re-encoding would not shrink it.
+    """
     try:
-        creds = Credentials(
-            token=None,
-            refresh_token=st.secrets["refresh_token"],
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=st.secrets["client_id"],
-            client_secret=st.secrets["client_secret"],
-            scopes=["https://www.googleapis.com/auth/drive.file"]
-        )
-        drive_service = build('drive', 'v3', credentials=creds)
-        logger.info(f"Uploading '{file_name}' to Drive folder '{folder_id}'")
+        img = Image.open(io.BytesIO(image_content))
+        img.thumbnail((SCREENSHOT_MAX_DIMENSION, SCREENSHOT_MAX_DIMENSION), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.convert('RGB').save(buffer, 'JPEG', quality=SCREENSHOT_JPEG_QUALITY, optimize=True)
+        compressed = buffer.getvalue()
+    except Exception as e:
+        logger.warning("Could not compress screenshot, uploading original: %s", e)
+        return image_content, mimetype
+    if len(compressed) >= len(image_content):
+        return image_content, mimetype
+    logger.debug("Compressed screenshot from %d to %d bytes.", len(image_content), len(compressed))
+    return compressed, 'image/jpeg'
+
+def make_drive_file_name(original_name, timestamp, extension):
+    """Builds a Drive-safe file name from the uploaded name and a timestamp."""
+    sanitized_name = original_name.rsplit('.', 1)[0].translate(_SANITIZE_TABLE)
+    return f"{sanitized_name}_{timestamp}.{extension}"
+
+@st.cache_resource
+def get_drive_credentials():
+    """Creates the Google Drive OAuth credentials once; the access token is refreshed on expiry."""
+    from google.oauth2.credentials import Credentials
+    return Credentials(
+        token=None,
+        refresh_token=st.secrets["refresh_token"],
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=st.secrets["client_id"],
+        client_secret=st.secrets["client_secret"],
+        scopes=["https://www.googleapis.com/auth/drive.file"]
+    )
+
+@st.cache_resource
+def get_drive_service():
+    """Builds the authorized Google Drive client once and reuses it for every upload."""
+    from googleapiclient.discovery import build
+    # Use the discovery document bundled with the client instead of fetching it
+    return build('drive', 'v3', credentials=get_drive_credentials(), cache_discovery=False, static_discovery=True)
+
+def execute_with_retry(call, file_name):
+    """Runs a Drive API call, retrying request timeouts (HTTP 408) with exponential backoff.
+
+    Rate limits and 5xx errors are already retried inside googleapiclient via num_retries.
+    """
+    from googleapiclient.errors import HttpError
+    for attempt in range(DRIVE_NUM_RETRIES + 1):
+        try:
+            return call()
+        except HttpError as e:
+            if e.resp.status != 408 or attempt == DRIVE_NUM_RETRIES:
+                raise
+            delay = min(2 ** attempt + random.random(), 60)
+            logger.warning("Drive request for '%s' timed out, retrying in %.1fs", file_name, delay)
+            time.sleep(delay)
+
+def upload_to_drive(file_content, file_name, folder_id, mimetype, drive_service, creds):
+    """Uploads file content to a specific Google Drive folder.
+
+    Safe to run on a worker thread: it never touches Streamlit elements, and each
+    call sends its requests over its own connection since httplib2 is not thread-safe.
+    """
+    import httplib2
+    from google.auth.exceptions import RefreshError
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import MediaIoBaseUpload, MediaInMemoryUpload
+    try:
+        http = AuthorizedHttp(creds, http=httplib2.Http())
+        logger.debug("Uploading '%s' to Drive folder '%s'", file_name, folder_id)
         file_metadata = {'name': file_name, 'parents': [folder_id]}
-        media = MediaIoBaseUpload(io.BytesIO(file_content), mimetype='application/octet-stream')
-        file = drive_service.files().create(
+        # Small files go up in one multipart POST; larger ones use a resumable session
+        if len(file_content) < RESUMABLE_UPLOAD_THRESHOLD_BYTES:
+            media = MediaInMemoryUpload(file_content, mimetype=mimetype, resumable=False)
+        else:
+            media = MediaIoBaseUpload(
+                io.BytesIO(file_content), mimetype=mimetype, chunksize=RESUMABLE_CHUNK_SIZE_BYTES, resumable=True
+            )
+        request = drive_service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id, webViewLink'
-        ).execute()
-        logger.info(f"File '{file_name}' uploaded successfully with ID: {file.get('id')}")
+        )
+        if media.resumable():
+            file = None
+            while file is None:
+                _, file = execute_with_retry(
+                    lambda: request.next_chunk(http=http, num_retries=DRIVE_NUM_RETRIES), file_name
+                )
+        else:
+            file = execute_with_retry(lambda: request.execute(http=http, num_retries=DRIVE_NUM_RETRIES), file_name)
+        logger.info("File '%s' uploaded successfully with ID: %s", file_name, file.get('id'))
         return file.get('webViewLink')
+    except RefreshError:
+        # Let the caller drop the cached credentials so the next attempt starts fresh
+        raise
     except Exception as e:
-        logger.error(f"Error uploading '{file_name}' to Drive: {str(e)}")
-        st.error(f"Failed to upload {file_name} to Google Drive.")
+        logger.error("Error uploading '%s' to Drive: %s", file_name, e)
         return None
 
-def save_request(phone, documents, screenshot_link):
-    """Save Pickup request metadata to Supabase."""
-    if not supabase:
-        st.error("Database connection unavailable.")
-        return None
-    try:
-        data = {
-            "phone": phone,
-            "screenshot_link": screenshot_link,
-            "documents": documents,
-            "submitted_at": datetime.now().isoformat(),
-            "status": "Pending"
+def upload_many_to_drive(uploads, folder_id, drive_service, creds):
+    """Uploads (content, file_name, mimetype) items to Drive concurrently; returns links in order."""
+    from google.auth.exceptions import RefreshError
+    if not uploads:
+        return []
+    # One worker per file, capped, so every document and the screenshot upload at once
+    with ThreadPoolExecutor(max_workers=min(DRIVE_UPLOAD_WORKERS, len(uploads))) as executor:
+        futures = [
+            executor.submit(upload_to_drive, content, file_name, folder_id, mimetype, drive_service, creds)
+            for content, file_name, mimetype in uploads
+        ]
+        links = []
+        refresh_failed = False
+        for future in futures:
+            try:
+                links.append(future.result())
+            except RefreshError as e:
+                logger.error("Failed to refresh Google Drive credentials: %s", e)
+                links.append(None)
+                refresh_failed = True
+    if refresh_failed:
+        get_drive_service.clear()
+        get_drive_credentials.clear()
+    return links
+
+def build_whatsapp_url(phone, screenshot_link, documents, total_price):
+    """Builds the wa.me link carrying the urgent request details for the shopkeeper."""
+    fields = [
+        ("Phone", phone),
+        ("Payment Proof Link", screenshot_link),
+        ("Payment Status", "Paid (Screenshot Uploaded)")
+    ]
+    message_lines = [f"{label}: {value}" for label, value in fields]
+    message_lines.append("--- Documents ---")
+    for idx, doc in enumerate(documents, 1):
+        doc_fields = (
+            ("Link", doc['doc_link']),
+            ("Total Pages", doc['pages']),
+            ("Copies", doc['copies']),
+            ("Mode", _MODE_LABELS[doc['is_color']]),
+            ("Layout", doc['layout']),
+            ("Pages per Sheet", doc['pages_per_sheet']),
+            ("Page Selection", doc['page_selection']),
+            ("Price", f"₹{doc['price']:.2f}")
+        )
+        message_lines.append(f"Document {idx}:")
+        message_lines.extend(f"{label}: {value}" for label, value in doc_fields if value not in (None, ""))
+        message_lines.append("---------")
+    message_lines.append(f"Total Price: ₹{total_price:.2f}")
+    encoded_message = "".join([_WHATSAPP_HEADER, quote_from_bytes("\n".join(message_lines).encode("utf-8"), safe=""), _WHATSAPP_FOOTER])
+    return f"https://wa.me/{SHOP_NUMBER}?text={encoded_message}"
+
+@st.cache_resource
+def get_request_writer():
+    """Starts the background thread that inserts Pickup requests; returns its queue.
+
+    Requests queued close together are inserted with a single multi-row insert.
+    """
+    client = get_supabase()
+    write_queue = queue.Queue()
+
+    def next_batch():
+        batch = [write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WAIT_SECONDS
+        while len(batch) < WRITE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(write_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def write_requests():
+        while True:
+            batch = next_batch()
+            try:
+                response = client.table("print_requests").insert([data for data, _ in batch]).execute()
+                # Inserted rows come back in the order they were sent
+                for (data, future), row in zip(batch, response.data):
+                    logger.info("Saved Pickup request for phone %s. ID: %s", data['phone'], row["id"])
+                    future.set_result(row["id"])
+                if len(response.data) < len(batch):
+                    raise RuntimeError("Insert returned fewer rows than requests sent")
+            except Exception as e:
+                logger.error("Failed to save %d request(s): %s", len(batch), e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    threading.Thread(target=write_requests, name="print-request-writer", daemon=True).start()
+    return write_queue
+
+def save_request(phone, documents, screenshot_link, submitted_at, write_queue):
+    """Queue Pickup request metadata for Supabase; returns a Future resolving to its ID."""
+    data = {
+        "phone": phone,
+        "screenshot_link": screenshot_link,
+        "documents": documents,
+        "submitted_at": submitted_at,
+        "status": "Pending"
+    }
+    future = Future()
+    write_queue.put((data, future))
+    return future
+
+@st.cache_resource
+def get_submission_pool():
+    """Creates the thread pool that runs submissions off the Streamlit script thread."""
+    return ThreadPoolExecutor(max_workers=SUBMISSION_WORKERS, thread_name_prefix="print-submission")
+
+def process_submission(submission, drive_service, creds, write_queue):
+    """Uploads a submission's files, then builds the WhatsApp link or saves the Pickup request.
+
+    Runs on a worker thread, so it only reads the submission snapshot and never touches
+    Streamlit. Returns the Drive links obtained plus 'whatsapp_url', 'request_id' or 'error'.
+    """
+    files = submission['files']
+    doc_links = [file_data['doc_link'] for file_data in files]
+    result = {'doc_links': doc_links, 'ss_link': submission['ss_link']}
+
+    # Upload any documents and the payment proof not yet on Drive in one concurrent batch
+    timestamp = submission['submitted_at'].strftime("%Y%m%d_%H%M%S")
+    # Identical documents in one submission share a single upload
+    first_by_hash = {}
+    for idx, doc_link in enumerate(doc_links):
+        if not doc_link:
+            first_by_hash.setdefault(files[idx]['sha256'], idx)
+    to_upload = list(first_by_hash.values())
+    uploads = [
+        (files[idx]['content'], make_drive_file_name(files[idx]['name'], timestamp, "pdf"), 'application/pdf')
+        for idx in to_upload
+    ]
+    if not result['ss_link']:
+        ss_content, ss_mimetype = compress_screenshot(submission['ss_content'], submission['ss_mimetype'])
+        uploads.append((ss_content, make_drive_file_name(submission['ss_name'], timestamp, "jpg"), ss_mimetype))
+
+    if uploads:
+        links = upload_many_to_drive(uploads, FOLDER_ID, drive_service, creds)
+        for idx, doc_link in zip(to_upload, links):
+            doc_links[idx] = doc_link
+        for idx, file_data in enumerate(files):
+            if not doc_links[idx]:
+                doc_links[idx] = doc_links[first_by_hash[file_data['sha256']]]
+        if not result['ss_link']:
+            result['ss_link'] = links[-1]
+        failed = [file_name for (_, file_name, _), link in zip(uploads, links) if not link]
+        if failed:
+            result['error'] = f"Failed to upload {', '.join(failed)} to Google Drive."
+            return result
+
+    documents = [
+        {
+            "doc_link": doc_link,
+            "pages": file_data['page_count'],
+            "copies": file_data['preferences']['copies'],
+            "is_color": file_data['preferences']['is_color'],
+            "layout": file_data['preferences']['print_layout'],
+            "pages_per_sheet": file_data['preferences']['pages_per_sheet'],
+            "page_selection": file_data['preferences']['page_preference'] + (f" ({format_page_ranges(file_data['preferences']['selected_pages'])})" if file_data['preferences']['page_preference'] == "Custom Pages" else ""),
+            "price": calculate_price(
+                billable_page_count(file_data),
+                file_data['preferences']['copies'],
+                file_data['preferences']['is_color'],
+                file_data['preferences']['print_layout']
+            )
         }
-        response = supabase.table("print_requests").insert(data).execute()
-        request_id = response.data[0]["id"]
-        logger.info(f"Saved Pickup request for phone {phone}. ID: {request_id}")
-        return request_id
+        for file_data, doc_link in zip(files, doc_links)
+    ]
+
+    if submission['request_type'] == "Urgent (Send via WhatsApp)":
+        result['whatsapp_url'] = build_whatsapp_url(submission['phone'], result['ss_link'], documents, submission['total_price'])
+    else:
+        try:
+            result['request_id'] = save_request(
+                submission['phone'], documents, result['ss_link'], submission['submitted_at'].isoformat(), write_queue
+            ).result()
+        except Exception as e:
+            result['error'] = f"Failed to save request to database: {str(e)}"
+    return result
+
+@st.fragment(run_every=SUBMISSION_POLL_SECONDS)
+def show_submission_status():
+    """Polls the background submission and reruns the app once it has finished."""
+    future = st.session_state.pending_submission
+    if not future.done():
+        st.info("⏳ Submitting your request...")
+        return
+    st.session_state.pending_submission = None
+    try:
+        result = future.result()
     except Exception as e:
-        logger.error(f"Failed to save request: {str(e)}")
-        st.error(f"Failed to save request: {str(e)}")
-        return None
+        logger.error("Submission failed: %s", e)
+        result = {'error': f"Failed to submit request: {str(e)}"}
+
+    # Keep the Drive links so a retry only uploads what is still missing; uploaded bytes are no longer needed
+    links_by_name = dict(zip(st.session_state.submitted_names, result.get('doc_links', [])))
+    for file_data in st.session_state.files_data.values():
+        if not file_data['doc_link']:
+            file_data['doc_link'] = links_by_name.get(file_data['name'])
+        if file_data['doc_link']:
+            file_data['content'] = None
+            st.session_state.uploaded_hashes[file_data['sha256']] = file_data['doc_link']
+    if result.get('ss_link'):
+        st.session_state.ss_link = result['ss_link']
+        st.session_state.ss_content = None
+
+    if 'error' in result:
+        st.session_state.submission_message = ("error", result['error'])
+    elif 'whatsapp_url' in result:
+        st.session_state.whatsapp_url = result['whatsapp_url']
+    else:
+        st.session_state.submission_message = ("success", f"✅ Success! Pickup request submitted to admin panel (ID: {result['request_id']}).")
+        st.session_state.files_data = {}
+        st.session_state.total_price = 0.0
+        st.session_state.ss_link = None
+        st.session_state.ss_content = None
+        st.session_state.ss_mimetype = None
+        st.session_state.ss_file_id = None
+    st.rerun()
 
 # --- Streamlit App UI ---
 st.set_page_config(page_title="PrintEasy", layout="centered")
@@ -121,13 +501,33 @@ st.markdown("Upload your documents and payment proof.")
 
 # Initialize session state
 if 'files_data' not in st.session_state:
-    st.session_state.files_data = []
+    st.session_state.files_data = {}
 if 'total_price' not in st.session_state:
     st.session_state.total_price = 0.0
 if 'ss_link' not in st.session_state:
     st.session_state.ss_link = None
 if 'ss_content' not in st.session_state:
     st.session_state.ss_content = None
+if 'ss_mimetype' not in st.session_state:
+    st.session_state.ss_mimetype = None
+if 'ss_file_id' not in st.session_state:
+    st.session_state.ss_file_id = None
+if 'uploaded_hashes' not in st.session_state:
+    st.session_state.uploaded_hashes = {}
+if 'pending_submission' not in st.session_state:
+    st.session_state.pending_submission = None
+if 'whatsapp_url' not in st.session_state:
+    st.session_state.whatsapp_url = None
+
+# Report on a request being submitted in the background
+if st.session_state.pending_submission:
+    show_submission_status()
+if st.session_state.get('submission_message'):
+    level, text = st.session_state.pop('submission_message')
+    if level == "success":
+        st.success(text)
+    else:
+        st.error(text)
 
 # Stop if Supabase failed to initialize
 if not supabase:
@@ -145,22 +545,23 @@ uploaded_files = st.file_uploader(
 )
 
 if uploaded_files:
-    new_files = []
-    existing_names = {file_data['name'] for file_data in st.session_state.files_data}
-    
     for uploaded_file in uploaded_files:
-        if uploaded_file.name not in existing_names:
-            content = uploaded_file.getvalue()
-            if len(content) > MAX_DOC_SIZE_BYTES:
+        if uploaded_file.name not in st.session_state.files_data:
+            if uploaded_file.size > MAX_DOC_SIZE_BYTES:
                 st.error(f"Document '{uploaded_file.name}' exceeds {MAX_DOC_SIZE_MB}MB limit.")
                 continue
+            content = uploaded_file.getvalue()
+            if not is_pdf(content):
+                st.error(f"Document '{uploaded_file.name}' is not a valid PDF file.")
+                continue
             page_count = get_pdf_page_count(content)
             if page_count == 0:
-                st.error(f"Could not read page count for '{uploaded_file.name}'.")
+                st.error(f"Could not read page count for '{uploaded_file.name}'. The file might be corrupted or password-protected.")
                 continue
-            new_files.append({
+            st.session_state.files_data[uploaded_file.name] = {
                 'name': uploaded_file.name,
                 'content': content,
+                'sha256': hashlib.sha256(content).hexdigest(),
                 'page_count': page_count,
                 'preferences': {
                     'copies': 1,
@@ -168,91 +569,88 @@ if uploaded_files:
                     'print_layout': "Single-sided",
                     'pages_per_sheet': "1 page per side",
                     'page_preference': "All Pages",
-                    'custom_pages': ""
+                    'custom_pages': "",
+                    'selected_pages': None
                 },
                 'doc_link': None
-            })
-    
-    st.session_state.files_data.extend(new_files)
+            }
 
 if st.session_state.files_data:
     st.markdown("### Uploaded Documents")
     total_price = 0.0
-    for idx, file_data in enumerate(st.session_state.files_data):
-        with st.expander(f"Document {idx + 1}: {file_data['name']} ({file_data['page_count']} pages)"):
-            col1, col2 = st.columns(2)
-            with col1:
-                is_color = st.radio(
-                    "Print Mode",
-                    (f"⚫ Black & White (₹{BW_PRICE_PER_SIDE:.2f}/side)", f"🌈 Color (₹{COLOR_PRICE_PER_SIDE:.2f}/side)"),
-                    key=f"print_mode_{idx}",
+    # Preference changes are applied together when the form is submitted, not one rerun per widget
+    with st.form("print_preferences", border=False):
+        for idx, file_data in enumerate(st.session_state.files_data.values()):
+            with st.expander(f"Document {idx + 1}: {file_data['name']} ({file_data['page_count']} pages)"):
+                col1, col2 = st.columns(2)
+                with col1:
+                    is_color = st.radio(
+                        "Print Mode",
+                        (_BW_LABEL, _COLOR_LABEL),
+                        key=f"print_mode_{idx}",
+                        horizontal=True
+                    )
+                    file_data['preferences']['is_color'] = is_color == _COLOR_LABEL
+                with col2:
+                    copies = st.number_input(
+                        "Number of Copies",
+                        min_value=1,
+                        max_value=20,
+                        value=file_data['preferences']['copies'],
+                        step=1,
+                        key=f"copies_input_{idx}"
+                    )
+                    file_data['preferences']['copies'] = copies
+
+                print_layout = st.radio(
+                    "Print Layout",
+                    ("Single-sided", "Double-sided"),
+                    key=f"print_layout_{idx}",
+                    index=0 if file_data['preferences']['print_layout'] == "Single-sided" else 1,
                     horizontal=True
                 )
-                file_data['preferences']['is_color'] = is_color.startswith("🌈")
-            with col2:
-                copies = st.number_input(
-                    "Number of Copies",
-                    min_value=1,
-                    max_value=20,
-                    value=file_data['preferences']['copies'],
-                    step=1,
-                    key=f"copies_input_{idx}"
+                file_data['preferences']['print_layout'] = print_layout
+
+                pages_per_sheet = st.selectbox(
+                    "Pages per Sheet Side",
+                    ("1 page per side", "2 pages per side"),
+                    key=f"pages_per_sheet_{idx}",
+                    index=0 if file_data['preferences']['pages_per_sheet'] == "1 page per side" else 1
                 )
-                file_data['preferences']['copies'] = copies
-
-            print_layout = st.radio(
-                "Print Layout",
-                ("Single-sided", "Double-sided"),
-                key=f"print_layout_{idx}",
-                index=0 if file_data['preferences']['print_layout'] == "Single-sided" else 1,
-                horizontal=True
-            )
-            file_data['preferences']['print_layout'] = print_layout
+                file_data['preferences']['pages_per_sheet'] = pages_per_sheet
 
-            pages_per_sheet = st.selectbox(
-                "Pages per Sheet Side",
-                ("1 page per side", "2 pages per side"),
-                key=f"pages_per_sheet_{idx}",
-                index=0 if file_data['preferences']['pages_per_sheet'] == "1 page per side" else 1
-            )
-            file_data['preferences']['pages_per_sheet'] = pages_per_sheet
-
-            page_preference = st.radio(
-                "Page Preference",
-                ("All Pages", "Custom Pages"),
-                key=f"page_preference_{idx}",
-                index=0 if file_data['preferences']['page_preference'] == "All Pages" else 1,
-                horizontal=True
-            )
-            file_data['preferences']['page_preference'] = page_preference
-            if page_preference == "Custom Pages":
+                page_preference = st.radio(
+                    "Page Preference",
+                    ("All Pages", "Custom Pages"),
+                    key=f"page_preference_{idx}",
+                    index=0 if file_data['preferences']['page_preference'] == "All Pages" else 1,
+                    horizontal=True
+                )
+                file_data['preferences']['page_preference'] = page_preference
+                # Widgets in a form cannot appear conditionally, so the page input is always shown
                 custom_pages = st.text_input(
                     "Enter Page Numbers (e.g., 1-3, 5, 7-10)",
                     key=f"custom_pages_input_{idx}",
-                    value=file_data['preferences']['custom_pages']
+                    value=file_data['preferences']['custom_pages'],
+                    help="Used when Page Preference is Custom Pages."
                 )
                 file_data['preferences']['custom_pages'] = custom_pages
-
-            file_price = calculate_price(
-                file_data['page_count'],
-                file_data['preferences']['copies'],
-                file_data['preferences']['is_color'],
-                file_data['preferences']['print_layout']
-            )
-            total_price += file_price
-            st.write(f"Price for this document: ₹{file_price:.2f}")
-
-            if not file_data['doc_link']:
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                sanitized_name = re.sub(r'\W+', '_', file_data['name'].split('.')[0])
-                doc_file_name = f"{sanitized_name}_{timestamp}.pdf"
-                doc_link = upload_to_drive(file_data['content'], doc_file_name, FOLDER_ID)
-                if doc_link:
-                    file_data['doc_link'] = doc_link
-                    st.success(f"✅ File uploaded: [View Document]({doc_link})")
-                else:
-                    st.error(f"Failed to upload '{file_data['name']}'.")
-                    st.stop()
+                if page_preference == "Custom Pages":
+                    selected_pages = parse_pages(custom_pages, file_data['page_count'])
+                    file_data['preferences']['selected_pages'] = selected_pages
+                    if custom_pages and selected_pages is None:
+                        st.warning(f"⚠ Enter valid page numbers between 1 and {file_data['page_count']} (e.g., 1-3, 5).")
+
+                file_price = calculate_price(
+                    billable_page_count(file_data),
+                    file_data['preferences']['copies'],
+                    file_data['preferences']['is_color'],
+                    file_data['preferences']['print_layout']
+                )
+                total_price += file_price
+                st.write(f"Price for this document: ₹{file_price:.2f}")
+        st.form_submit_button("Update Prices")
+        st.caption("Click Update Prices after changing preferences; unsaved changes are not included in your request.")
 
     st.session_state.total_price = total_price
     st.markdown("### Total Estimated Price")
@@ -302,100 +700,77 @@ payment_screenshot = st.file_uploader(
     key="ss_uploader"
 )
 
-if payment_screenshot:
-    ss_content = payment_screenshot.getvalue()
-    if len(ss_content) > MAX_IMG_SIZE_BYTES:
+# Read the screenshot only when a different file is uploaded, so it is not pulled back in after it is on Drive
+if payment_screenshot and payment_screenshot.file_id != st.session_state.ss_file_id:
+    if payment_screenshot.size > MAX_IMG_SIZE_BYTES:
         st.error(f"Screenshot exceeds {MAX_IMG_SIZE_MB}MB limit.")
         st.stop()
+    ss_content = payment_screenshot.getvalue()
+    ss_mimetype = sniff_image_type(ss_content)
+    if not ss_mimetype:
+        st.error("Screenshot is not a valid JPG or PNG image.")
+        st.stop()
     st.session_state.ss_content = ss_content
-
-    if not st.session_state.ss_link:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        sanitized_name = re.sub(r'\W+', '_', payment_screenshot.name.split('.')[0])
-        ss_file_name = f"{sanitized_name}_{timestamp}.jpg"
-        ss_link = upload_to_drive(ss_content, ss_file_name, FOLDER_ID)
-        if ss_link:
-            st.session_state.ss_link = ss_link
-            st.success(f"✅ Payment screenshot uploaded: [View Screenshot]({ss_link})")
-        else:
-            st.stop()
+    st.session_state.ss_mimetype = ss_mimetype
+    st.session_state.ss_link = None
+    st.session_state.ss_file_id = payment_screenshot.file_id
 
 # --- Step 5: Submit Form ---
 if st.button("Send Print Request"):
-    if not (all(file_data['doc_link'] for file_data in st.session_state.files_data) and st.session_state.ss_link and validate_phone(phone)):
+    if not (st.session_state.files_data and payment_screenshot and (st.session_state.ss_content or st.session_state.ss_link) and validate_phone(phone)):
         st.error("❌ Missing required information.")
         st.stop()
+    if st.session_state.pending_submission:
+        st.error("❌ Your previous request is still being submitted.")
+        st.stop()
 
-    documents = [
-        {
-            "doc_link": file_data['doc_link'],
-            "pages": file_data['page_count'],
-            "copies": file_data['preferences']['copies'],
-            "is_color": file_data['preferences']['is_color'],
-            "layout": file_data['preferences']['print_layout'],
-            "pages_per_sheet": file_data['preferences']['pages_per_sheet'],
-            "page_selection": file_data['preferences']['page_preference'] + (f" ({file_data['preferences']['custom_pages']})" if file_data['preferences']['page_preference'] == "Custom Pages" else ""),
-            "price": calculate_price(
-                file_data['page_count'],
-                file_data['preferences']['copies'],
-                file_data['preferences']['is_color'],
-                file_data['preferences']['print_layout']
-            )
-        }
-        for file_data in st.session_state.files_data
+    invalid_selections = [
+        file_data['name'] for file_data in st.session_state.files_data.values()
+        if file_data['preferences']['page_preference'] == "Custom Pages" and not file_data['preferences']['selected_pages']
     ]
+    if invalid_selections:
+        st.error(f"❌ Invalid custom page selection for: {', '.join(invalid_selections)}.")
+        st.stop()
 
-    if request_type == "Urgent (Send via WhatsApp)":
-        message_lines = [
-            "New Urgent Print Request",
-            f"Phone: {phone}",
-            f"Payment Proof Link: {st.session_state.ss_link}",
-            f"Payment Status: Paid (Screenshot Uploaded)",
-            "--- Documents ---"
-        ]
-        for idx, doc in enumerate(documents, 1):
-            message_lines.extend([
-                f"Document {idx}:",
-                f"Link: {doc['doc_link']}",
-                f"Total Pages: {doc['pages']}",
-                f"Copies: {doc['copies']}",
-                f"Mode: {'Color' if doc['is_color'] else 'Black & White'}",
-                f"Layout: {doc['layout']}",
-                f"Pages per Sheet: {doc['pages_per_sheet']}",
-                f"Page Selection: {doc['page_selection']}",
-                f"Price: ₹{doc['price']:.2f}",
-                "---------"
-            ])
-        message_lines.extend([
-            f"Total Price: ₹{st.session_state.total_price:.2f}",
-            "---",
-            "Please confirm the order details."
-        ])
-        message = "\n".join(message_lines)
-        encoded_message = quote(message)
-        whatsapp_url = f"https://wa.me/{SHOP_NUMBER}?text={encoded_message}"
-
-        st.markdown(
-            f"""
-            ### Your request is ready!
-            Click the button below to send the details to the shopkeeper via WhatsApp.
-            <a href="{whatsapp_url}" target="_blank" style="background-color: #25D366; color: white; padding: 10px 20px; text-align: center; text-decoration: none; display: inline-block; border-radius: 5px; font-weight: bold;">
-                Send Details via WhatsApp
-            </a>
-            """,
-            unsafe_allow_html=True
-        )
+    # Reuse the Drive link of any identical document already uploaded this session
+    for file_data in st.session_state.files_data.values():
+        if not file_data['doc_link'] and file_data['sha256'] in st.session_state.uploaded_hashes:
+            file_data['doc_link'] = st.session_state.uploaded_hashes[file_data['sha256']]
+            file_data['content'] = None
+
+    # Hand uploads and saving to a worker thread so the script, and the UI, return immediately
+    st.session_state.whatsapp_url = None
+    st.session_state.submitted_names = list(st.session_state.files_data)
+    submission = {
+        'phone': phone,
+        'request_type': request_type,
+        'submitted_at': datetime.now(),
+        'total_price': st.session_state.total_price,
+        'files': [
+            {**file_data, 'preferences': dict(file_data['preferences'])}
+            for file_data in st.session_state.files_data.values()
+        ],
+        'ss_name': payment_screenshot.name,
+        'ss_content': st.session_state.ss_content,
+        'ss_mimetype': st.session_state.ss_mimetype,
+        'ss_link': st.session_state.ss_link
+    }
+    st.session_state.pending_submission = get_submission_pool().submit(
+        process_submission, submission, get_drive_service(), get_drive_credentials(), get_request_writer()
+    )
+    st.rerun()
 
-    elif request_type == "Pickup (Send to Admin Panel)":
-        request_id = save_request(phone, documents, st.session_state.ss_link)
-        if request_id:
-            st.success(f"✅ Success! Pickup request submitted to admin panel (ID: {request_id}).")
-            st.session_state.files_data = []
-            st.session_state.total_price = 0.0
-            st.session_state.ss_link = None
-            st.session_state.ss_content = None
-        else:
-            st.error("Failed to save request to database.")
+if st.session_state.whatsapp_url:
+    st.markdown(
+        f"""
+        ### Your request is ready!
+        Click the button below to send the details to the shopkeeper via WhatsApp.
+        <a href="{st.session_state.whatsapp_url}" target="_blank" style="background-color: #25D366; color: white; padding: 10px 20px; text-align: center; text-decoration: none; display: inline-block; border-radius: 5px; font-weight: bold;">
+            Send Details via WhatsApp
+        </a>
+        """,
+        unsafe_allow_html=True
+    )
 
 # Footer
 st.markdown("---")